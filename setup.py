@@ -13,6 +13,8 @@ setup(
     install_requires=[
         "jsonschema==2.6.0",
         "singer-python==5.12.2",
+        "orjson==3.9.10",
+        "fastjsonschema==2.19.0",
         "pyarrow==14.0.1",
         "psutil==5.9.1",
     ],
@@ -8,14 +8,15 @@ import http.client
 import os
 import sys
 import threading
-import time
 import urllib
 from datetime import datetime
 from enum import Enum
-from io import TextIOWrapper
-from multiprocessing import get_context
-from typing import TYPE_CHECKING
+from io import TextIOBase
+from queue import Queue
+from typing import IO
 
+import fastjsonschema
+import orjson
 import pkg_resources
 import psutil
 import pyarrow as pa
@@ -24,10 +25,12 @@ import singer
 from jsonschema.validators import Draft4Validator
 from pyarrow.parquet import ParquetWriter
 
-from .helpers import flatten, flatten_schema
-
-if TYPE_CHECKING:
-    from multiprocessing import Queue
+from .helpers import (
+    compile_flattener,
+    flatten_schema,
+    flatten_schema_types,
+    only_checks_types,
+)
 
 _all__ = ["main"]
 
@@ -35,12 +38,85 @@ LOGGER = singer.get_logger()
 LOGGER.setLevel(os.getenv("LOGGER_LEVEL", "INFO"))
 
 
-def create_dataframe(list_dict):
-    fields = set()
-    for d in list_dict:
-        fields = fields.union(d.keys())
-    dataframe = pa.table({f: [row.get(f) for row in list_dict] for f in fields})
-    return dataframe
+# Number of messages the producer can queue ahead of the consumer before it blocks
+QUEUE_SIZE = 64
+
+# Number of bytes read from a binary input at once
+READ_BUFFER_SIZE = 1 << 20
+
+# Number of records the producer converts into a single record batch for the consumer
+MESSAGE_BATCH_SIZE = 1024
+
+
+def create_record_batch(fields, columns, types):
+    """Builds a pyarrow record batch from the list of values of each field, letting pyarrow build each column
+    array at once instead of row by row. The values are converted to the given pyarrow types."""
+    return pa.RecordBatch.from_arrays(
+        [create_array(values, arrow_type) for values, arrow_type in zip(columns, types)],
+        names=list(fields),
+    )
+
+
+def create_array(values, arrow_type):
+    """Builds a pyarrow array of the given type, failing on the values that cannot be converted to it without loss.
+    pyarrow truncates the floats converted to integers, so integer columns are built from the inferred type first,
+    which is then cast safely, failing on fractional values."""
+    if pa.types.is_integer(arrow_type):
+        array = pa.array(values)
+        if array.type == arrow_type:
+            return array
+        if pa.types.is_floating(array.type) or pa.types.is_null(array.type):
+            return array.cast(arrow_type)
+    return pa.array(values, type=arrow_type)
+
+
+def read_lines(message_buffer, buffer_size=READ_BUFFER_SIZE):
+    """Yields the lines of the input. Binary inputs are read in big chunks that are split with bytes.split,
+    so the lines are never decoded, as orjson parses UTF-8 bytes directly. Text inputs and any other iterable
+    of lines, such as a list, are iterated as they are."""
+    if isinstance(message_buffer, TextIOBase) or not hasattr(message_buffer, "read"):
+        yield from message_buffer
+        return
+    read = getattr(message_buffer, "read1", message_buffer.read)
+    # pending holds the chunks of a line that spans over several reads
+    pending = []
+    while True:
+        chunk = read(buffer_size)
+        if not chunk:
+            break
+        lines = chunk.split(b"\n")
+        if len(lines) == 1:
+            pending.append(chunk)
+            continue
+        pending.append(lines[0])
+        lines[0] = b"".join(pending)
+        pending = [lines.pop()]
+        yield from lines
+    remainder = b"".join(pending)
+    if remainder:
+        yield remainder
+
+
+def compile_validator(schema):
+    """Generates a validation function for the schema. Schemas without a declared version are
+    validated as Draft 4, and neither defaults nor formats are applied, as in jsonschema's Draft4Validator."""
+    try:
+        return fastjsonschema.compile(
+            {"$schema": "http://json-schema.org/draft-04/schema#", **schema},
+            use_default=False,
+            use_formats=False,
+        )
+    except fastjsonschema.JsonSchemaDefinitionException as Err:
+        LOGGER.warning(f"Unable to compile the schema, falling back to Draft4Validator: {Err}")
+        return Draft4Validator(schema).validate
+
+
+# Keys that the Singer specification requires in each type of message
+REQUIRED_KEYS = {
+    "RECORD": ("stream", "record"),
+    "SCHEMA": ("stream", "schema", "key_properties"),
+    "STATE": ("value",),
+}
 
 
 class MessageType(Enum):
@@ -48,51 +124,60 @@ class MessageType(Enum):
     STATE = 2
     SCHEMA = 3
     EOF = 4
+    RECORD_BATCH = 5
 
 
 def emit_state(state):
     if state is not None:
-        line = json.dumps(state)
-        LOGGER.debug("Emitting state {}".format(line))
+        line = orjson.dumps(state).decode()
+        LOGGER.debug("Emitting state %s", line)
         sys.stdout.write("{}\n".format(line))
         sys.stdout.flush()
 
 
 class MemoryReporter(threading.Thread):
-    """Logs memory usage every 30 seconds"""
+    """Logs memory usage every interval seconds, until it is stopped"""
 
-    def __init__(self):
+    def __init__(self, interval=30.0):
         self.process = psutil.Process()
+        self.interval = interval
+        # threading.Thread already defines a _stop method, hence the name
+        self._stop_event = threading.Event()
         super().__init__(name="memory_reporter", daemon=True)
 
     def run(self):
-        while True:
-            LOGGER.debug(
+        memory_percent = self.process.memory_percent
+        memory_info = self.process.memory_info
+        while not self._stop_event.wait(self.interval):
+            LOGGER.info(
                 "Virtual memory usage: %.2f%% of total: %s",
-                self.process.memory_percent(),
-                self.process.memory_info(),
+                memory_percent(),
+                memory_info(),
             )
-            time.sleep(30.0)
+
+    def stop(self):
+        self._stop_event.set()
 
 
 def persist_messages(
     messages,
     destination_path,
-    parquet_version,
+    parquet_version="1.0",
     compression_method=None,
     streams_in_separate_folder=False,
     file_size=-1,
+    validate_records=False,
+    row_group_size=1_000_000,
+    data_page_size=1 << 20,
+    write_statistics=True,
+    aggressive_gc=False,
 ):
-    # Multiprocessing context
-    if sys.platform == "darwin" or sys.platform == 'linux':
-        ctx = get_context("fork")
-    else:
-        ctx = get_context("spawn")
-
-    ## Static information shared among processes
+    ## Static information shared among threads
     schemas = {}
     key_properties = {}
     validators = {}
+    flatteners = {}
+    arrow_types = {}
 
     compression_extension = ""
     if compression_method:
@@ -115,19 +200,39 @@ def persist_messages(
         filename_separator = os.path.sep
     if not os.path.exists(destination_path):
         os.makedirs(destination_path)
-    ## End of Static information shared among processes
+    ## End of Static information shared among threads
 
     # Object that signals shutdown
     _break_object = object()
 
-    def producer(message_buffer: TextIOWrapper, w_queue: Queue):
+    def producer(message_buffer: IO):
         state = None
+        # columns holds, for each stream, one list per schema field where the flatteners append the values of the records
+        # not sent to the consumer yet, and pending holds the number of those records
+        columns = {}
+        pending = {}
+        # json_schemas holds the last schema received for each stream, as it was sent by the tap
+        json_schemas = {}
+
+        def send_pending():
+            # The records are handed over as arrow record batches, so the consumer only deals with columnar data.
+            # pyarrow copies the values, so the lists are cleared and reused by the stream's flattener.
+            for stream_name in list(pending):
+                del pending[stream_name]
+                batch = create_record_batch(
+                    schemas[stream_name], columns[stream_name], arrow_types[stream_name]
+                )
+                for values in columns[stream_name]:
+                    values.clear()
+                send(MessageType.RECORD_BATCH, stream_name, batch)
+
         try:
-            for message in message_buffer:
-                LOGGER.debug(f"target-parquet got message: {message}")
+            for message in read_lines(message_buffer):
+                # Lazy formatting, as the message is only rendered when debug logging is enabled
+                LOGGER.debug("target-parquet got message: %s", message)
                 try:
-                    message = singer.parse_message(message).asdict()
-                except json.decoder.JSONDecodeError:
+                    message = orjson.loads(message)
+                except orjson.JSONDecodeError:
                     raise Exception("Unable to parse:\n{}".format(message))
 
                 message_type = message["type"]
@@ -139,37 +244,78 @@ def persist_messages(
                             )
                         )
                     stream_name = message["stream"]
-                    validators[message["stream"]].validate(message["record"])
-                    flattened_record = flatten(message["record"])
-                    # Once the record is flattenned, it is added to the final record list, which will be stored in the parquet file.
-                    w_queue.put((MessageType.RECORD, stream_name, flattened_record))
+                    if validators[stream_name] is not None:
+                        validators[stream_name](message["record"])
+                    # The record is flattenned straight into the stream columns, which are sent to the consumer in batches.
+                    flatteners[stream_name](message["record"])
+                    pending[stream_name] = pending.get(stream_name, 0) + 1
+                    if pending[stream_name] >= MESSAGE_BATCH_SIZE:
+                        send_pending()
                     state = None
                 elif message_type == "STATE":
-                    LOGGER.debug("Setting state to {}".format(message["value"]))
+                    LOGGER.debug("Setting state to %s", message["value"])
                     state = message["value"]
                 elif message_type == "SCHEMA":
                     stream = message["stream"]
-                    validators[stream] = Draft4Validator(message["schema"])
-                    schemas[stream] = flatten_schema(message["schema"]["properties"])
-                    LOGGER.debug(f"Schema: {schemas[stream]}")
                     key_properties[stream] = message["key_properties"]
-                    w_queue.put((MessageType.SCHEMA, stream, schemas[stream]))
+                    # Taps often send the schema of a stream again, which leaves its flattener and pending records as they are
+                    if json_schemas.get(stream) == message["schema"]:
+                        continue
+                    send_pending()
+                    json_schemas[stream] = message["schema"]
+                    # When the schema only constrains the types of the fields, the records are validated by
+                    # the flattener itself while they are flattened, instead of being walked once more
+                    check_types = validate_records and only_checks_types(message["schema"])
+                    validators[stream] = None
+                    if validate_records and not check_types:
+                        validators[stream] = compile_validator(message["schema"])
+                    # The flattened fields, in the same order as the stream columns
+                    schemas[stream] = tuple(
+                        flatten_schema(message["schema"]["properties"])
+                    )
+                    LOGGER.debug(f"Schema: {schemas[stream]}")
+                    arrow_types[stream] = flatten_schema_types(
+                        message["schema"]["properties"]
+                    )
+                    columns[stream] = [[] for _ in schemas[stream]]
+                    flatteners[stream] = compile_flattener(
+                        message["schema"]["properties"],
+                        columns[stream],
+                        check_types=check_types,
+                    )
+                    # The consumer gets the arrow schema, so a change in the type of a field also starts a new file
+                    send(
+                        MessageType.SCHEMA,
+                        stream,
+                        pa.schema(list(zip(schemas[stream], arrow_types[stream]))),
+                    )
                 else:
                     LOGGER.warning(
                         "Unknown message type {} in message {}".format(
                             message["type"], message
                         )
                     )
-            w_queue.put((MessageType.EOF, _break_object, None))
+            send_pending()
+            send_eof()
             return state
-        except Exception as Err:
-            w_queue.put((MessageType.EOF, _break_object, None))
+        except KeyError as Err:
+            send_eof()
+            # The messages are used as parsed, so the required keys are only looked for once a lookup failed
+            if isinstance(message, dict):
+                for key in ("type",) + REQUIRED_KEYS.get(message.get("type"), ()):
+                    if key not in message:
+                        raise Exception(
+                            "Message is missing required key '{}': {}".format(key, message)
+                        ) from Err
+            raise Err
+        except BaseException as Err:
+            # Also on KeyboardInterrupt, as the consumers would otherwise wait for more messages forever
+            send_eof()
             raise Err
 
-    def write_file(current_stream_name, record):
+    def open_writer(current_stream_name, schema):
         timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S-%f")
         LOGGER.debug(f"Writing files from {current_stream_name} stream")
-        dataframe = create_dataframe(record)
         if streams_in_separate_folder and not os.path.exists(
             os.path.join(destination_path, current_stream_name)
         ):
@@ -182,64 +328,128 @@ def persist_messages(
             + ".parquet"
         )
         filepath = os.path.expanduser(os.path.join(destination_path, filename))
-        with open(filepath, "wb") as f:
-            ParquetWriter(
-                f, dataframe.schema, compression=compression_method, version=parquet_version
-            ).write_table(dataframe)
-        ## explicit memory management. This can be usefull when working on very large data groups
-        del dataframe
-        return filepath
+        writer = ParquetWriter(
+            filepath,
+            schema,
+            compression=compression_method,
+            version=parquet_version,
+            data_page_size=data_page_size,
+            write_statistics=write_statistics,
+        )
+        return writer, filepath
 
     def consumer(receiver):
-        files_created = []
-        current_stream_name = None
-        # records is a list of dictionary of lists of dictionaries that will contain the records that are retrieved from the tap
-        records = {}
-        schemas = {}
+        # Each stream has its own consumer, which is the only one writing the stream files. The consumers encode and
+        # compress their batches (releasing the GIL) in parallel, while the producer keeps reading the input.
+        writer = None
+        # row_group holds the batches waiting to be written as a single row group,
+        # as every write to a parquet writer produces at least one row group
+        row_group = []
+        rows_in_row_group = 0
+        rows_in_file = 0
+        schema = None
+
+        def append_batch(stream_name, batch):
+            nonlocal writer, rows_in_row_group
+            # Every column type comes from the stream schema, so the batches always match the file being written
+            if writer is None:
+                writer, filepath = open_writer(stream_name, schema)
+                files_created.append(filepath)
+            row_group.append(batch)
+            rows_in_row_group += batch.num_rows
+            while rows_in_row_group >= row_group_size:
+                write_row_group(row_group_size)
+
+        def write_row_group(num_rows):
+            # Only the first num_rows rows are written, so every row group but the last one of a file has exactly
+            # row_group_size rows. The rest of the rows are sliced without copying them and kept for the next one.
+            nonlocal rows_in_row_group
+            table = pa.Table.from_batches(row_group)
+            row_group[:] = table.slice(num_rows).to_batches()
+            rows_in_row_group -= num_rows
+            writer.write_table(table.slice(0, num_rows), row_group_size=row_group_size)
+
+        def close_file():
+            nonlocal writer, rows_in_file
+            if writer is not None:
+                if rows_in_row_group:
+                    write_row_group(rows_in_row_group)
+                row_group.clear()
+                writer.close()
+                writer = None
+                ## explicit memory management. The buffers are reused, so this only helps on memory constrained environments
+                if aggressive_gc:
+                    gc.collect()
+            rows_in_file = 0
 
         while True:
             (message_type, stream_name, record) = receiver.get()  # q.get()
-            if message_type == MessageType.RECORD:
-                if (stream_name != current_stream_name) and (
-                    current_stream_name != None
-                ):
-                    files_created.append(
-                        write_file(
-                            current_stream_name, records.pop(current_stream_name)
-                        )
-                    )
-                    ## explicit memory management. This can be usefull when working on very large data groups
-                    gc.collect()
-                current_stream_name = stream_name
-                if type(records.get(stream_name)) != list:
-                    records[stream_name] = [record]
-                else:
-                    records[stream_name].append(record)
-                    if (file_size > 0) and (not len(records[stream_name]) % file_size):
-                        files_created.append(
-                            write_file(
-                                current_stream_name, records.pop(current_stream_name)
-                            )
-                        )
-                        gc.collect()
+            if message_type == MessageType.RECORD_BATCH:
+                # The file is only closed once it reaches file_size rows, the schema changes or the input ends
+                start = 0
+                while start < record.num_rows:
+                    # Only the rows that fit in the current file are taken, slicing the batch without copying it
+                    size = record.num_rows - start
+                    if file_size > 0:
+                        size = min(size, file_size - rows_in_file)
+                    append_batch(stream_name, record.slice(start, size))
+                    rows_in_file += size
+                    start += size
+                    if (file_size > 0) and (rows_in_file >= file_size):
+                        close_file()
             elif message_type == MessageType.SCHEMA:
-                schemas[stream_name] = record
+                # A schema change invalidates the file written so far for the stream
+                if schema is not None and schema != record:
+                    close_file()
+                schema = record
             elif message_type == MessageType.EOF:
-                files_created.append(
-                    write_file(current_stream_name, records.pop(current_stream_name))
-                )
-                LOGGER.info(f"Wrote {len(files_created)} files")
-                LOGGER.debug(f"Wrote {files_created} files")
+                close_file()
                 break
 
-    q = ctx.Queue()
-    t2 = ctx.Process(
-        target=consumer,
-        args=(q,),
-    )
-    t2.start()
-    state = producer(messages, q)
-    t2.join()
+    def run_consumer(receiver):
+        try:
+            consumer(receiver)
+        except Exception as Err:
+            consumer_errors.append(Err)
+            # Keeps draining the queue so the producer is never blocked on it
+            while receiver.get()[0] != MessageType.EOF:
+                pass
+
+    # consumers holds the thread and queue of each stream. The consumers are threads, so messages are
+    # handed over by reference instead of being pickled.
+    consumers = {}
+    consumer_errors = []
+    files_created = []
+
+    def send(message_type, stream_name, data):
+        if stream_name not in consumers:
+            receiver = Queue(maxsize=QUEUE_SIZE)
+            thread = threading.Thread(
+                target=run_consumer, args=(receiver,), name=f"consumer-{stream_name}"
+            )
+            thread.start()
+            consumers[stream_name] = (thread, receiver)
+        consumers[stream_name][1].put((message_type, stream_name, data))
+
+    def send_eof():
+        for _, receiver in consumers.values():
+            receiver.put((MessageType.EOF, _break_object, None))
+
+    # The records are short lived and freed by reference counting, so the cyclic garbage collector only adds pauses,
+    # growing with the number of live objects, while the messages are ingested
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        state = producer(messages)
+    finally:
+        for thread, _ in consumers.values():
+            thread.join()
+        if gc_enabled:
+            gc.enable()
+    if consumer_errors:
+        raise consumer_errors[0]
+    LOGGER.info(f"Wrote {len(files_created)} files")
+    LOGGER.debug(f"Wrote {files_created} files")
     return state
 
 
@@ -282,10 +492,12 @@ def main():
             + 'the config parameter "disable_collection" to true'
         )
         threading.Thread(target=send_usage_stats).start()
-    # The target expects that the tap generates UTF-8 encoded text.
-    input_messages = TextIOWrapper(sys.stdin.buffer, encoding="utf-8")
-    if LOGGER.level == 0:
-        MemoryReporter().start()
+    # The target expects that the tap generates UTF-8 encoded text, which is parsed without being decoded first.
+    input_messages = sys.stdin.buffer
+    memory_reporter = None
+    if config.get("memory_report_interval"):
+        memory_reporter = MemoryReporter(float(config["memory_report_interval"]))
+        memory_reporter.start()
     state = persist_messages(
         input_messages,
         destination_path=config.get("destination_path", "."),
@@ -293,7 +505,14 @@ def main():
         parquet_version=config.get("parquet_version", "1.0"),
         streams_in_separate_folder=config.get("streams_in_separate_folder", False),
         file_size=int(config.get("file_size", -1)),
+        validate_records=config.get("validate_records", False),
+        row_group_size=int(config.get("row_group_size", 1_000_000)),
+        data_page_size=int(config.get("data_page_size", 1 << 20)),
+        write_statistics=config.get("write_statistics", True),
+        aggressive_gc=config.get("aggressive_gc", False),
     )
+    if memory_reporter is not None:
+        memory_reporter.stop()
 
     emit_state(state)
     LOGGER.debug("Exiting normally")
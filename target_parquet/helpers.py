@@ -3,8 +3,10 @@ try:
 except ImportError:
     from collections import MutableMapping  # deprecated in Python 3.3
 
+import pyarrow as pa
 import singer
 import os
+from itertools import count
 
 LOGGER = singer.get_logger()
 LOGGER.setLevel(os.getenv("LOGGER_LEVEL", "INFO"))
@@ -31,14 +33,20 @@ def flatten(dictionary, parent_key="", sep="__"):
              'key_2__key_4__key_6': "['10', '11']"
          }
     """
-    items = []
-    for k, v in dictionary.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, MutableMapping):
-            items.extend(flatten(v, new_key, sep=sep).items())
+    flattened = {}
+    # The nested structure is walked iteratively, keeping the items left to visit in each level on a stack
+    stack = [(parent_key, iter(dictionary.items()))]
+    while stack:
+        prefix, items = stack[-1]
+        for k, v in items:
+            new_key = prefix + sep + k if prefix else k
+            if isinstance(v, MutableMapping):
+                stack.append((new_key, iter(v.items())))
+                break
+            flattened[new_key] = str(v) if type(v) is list else v
         else:
-            items.append((new_key, str(v) if type(v) is list else v))
-    return dict(items)
+            stack.pop()
+    return flattened
 
 
 def flatten_schema(dictionary, parent_key="", sep="__"):
@@ -76,6 +84,7 @@ def flatten_schema(dictionary, parent_key="", sep="__"):
              'key_2__key_4__key_5',
              'key_2__key_4__key_6'
         ]
+    Objects without properties have free-form values, so they are kept in a single field, like arrays.
     """
     items = []
     if dictionary:
@@ -83,8 +92,256 @@ def flatten_schema(dictionary, parent_key="", sep="__"):
             new_key = parent_key + sep + k if parent_key else k
             if "type" not in v:
                 LOGGER.warning(f"SCHEMA with limitted support on field {k}: {v}")
-            if "object" in v.get("type", []):
+            if _has_properties(v):
                 items.extend(flatten_schema(v.get("properties"), new_key, sep=sep))
             else:
                 items.append(new_key)
     return items
+
+
+def compile_flattener(dictionary, columns, check_types=False):
+    """Function that generates, from the properties of a schema, a function specialized in flattening records of that schema.
+    The generated function appends the value of each field given by flatten_schema to the list in the same position of columns,
+    so no intermediate structure is created for the record. It uses direct lookups instead of walking each record,
+    and it behaves as flatten for the fields in the schema, except that free-form objects are stored as strings.
+    E.g:
+     dictionary =  {
+                        'key_1': {'type': ['null', 'integer']},
+                        'key_2': {
+                            'type': ['null', 'object'],
+                            'properties': {
+                                'key_3': {'type': ['null', 'string']},
+                                'key_4': {'type': ['null', 'array']}
+                            }
+                        }
+                    }
+    By calling the function with the dictionary above and three lists as parameters, you will get a function equivalent to:
+        def flatten_record(record):
+            v0 = record.get('key_1')
+            if type(v0) is list:
+                v0 = str(v0)
+            elif type(v0) is dict:
+                v0 = None
+            v1 = record.get('key_2')
+            if type(v1) is dict:
+                v2 = v1.get('key_3')
+                if type(v2) is list:
+                    v2 = str(v2)
+                elif type(v2) is dict:
+                    v2 = None
+                v3 = v1.get('key_4')
+                if type(v3) is list:
+                    v3 = str(v3)
+                elif type(v3) is dict:
+                    v3 = None
+            else:
+                v2 = v3 = None
+            append_0(v0)
+            append_1(v2)
+            append_2(v3)
+    Where append_0, append_1 and append_2 are the append methods of the lists in columns.
+    With check_types, the generated function also checks the type of every field declaring one, raising a ValueError
+    when it does not match, so the record is validated in the same pass (see only_checks_types).
+    """
+    lines = []
+    counter = count()
+
+    namespace = {"_MISSING": _MISSING}
+
+    def add_type_check(var, schema, path, indent):
+        types = _json_types(schema)
+        allowed = tuple(py_type for t in types for py_type in _PYTHON_TYPES[t])
+        if "null" not in types:
+            allowed += (_Missing,)
+        namespace[f"_types_{var}"] = allowed
+        lines.append(f"{indent}if type({var}) not in _types_{var}:")
+        lines.append(
+            f"{indent}    raise ValueError({path + ' must be ' + ' or '.join(types)!r})"
+        )
+
+    def add_properties(properties, source, path, indent):
+        properties_leaves = []
+        for k, v in (properties or {}).items():
+            var = f"v{next(counter)}"
+            checked = check_types and "type" in v
+            if checked and "null" not in _json_types(v):
+                # A missing field is valid, unlike a null one, so it is told apart from None until it is checked
+                lines.append(f"{indent}{var} = {source}.get({k!r}, _MISSING)")
+            else:
+                lines.append(f"{indent}{var} = {source}.get({k!r})")
+            if checked:
+                add_type_check(var, v, f"{path}.{k}", indent)
+            if _has_properties(v):
+                lines.append(f"{indent}if type({var}) is dict:")
+                nested_leaves = add_properties(
+                    v["properties"], var, f"{path}.{k}", indent + "    "
+                )
+                lines.append(f"{indent}else:")
+                lines.append(f"{indent}    {' = '.join(nested_leaves)} = None")
+                properties_leaves.extend(nested_leaves)
+            else:
+                if checked and "null" not in _json_types(v):
+                    lines.append(f"{indent}if {var} is _MISSING:")
+                    lines.append(f"{indent}    {var} = None")
+                if "object" in v.get("type", []) or _arrow_type(v) is None:
+                    # Free-form objects and fields of ambiguous type are stored as strings, like lists
+                    lines.append(f"{indent}if {var} is not None and type({var}) is not str:")
+                    lines.append(f"{indent}    {var} = str({var})")
+                else:
+                    lines.append(f"{indent}if type({var}) is list:")
+                    lines.append(f"{indent}    {var} = str({var})")
+                    lines.append(f"{indent}elif type({var}) is dict:")
+                    lines.append(f"{indent}    {var} = None")
+                properties_leaves.append(var)
+        return properties_leaves
+
+    if check_types:
+        lines.append("        if type(record) is not dict:")
+        lines.append("            raise ValueError('data must be object')")
+    leaves = add_properties(dictionary, "record", "data", "        ")
+    appends = [f"append_{i}" for i in range(len(leaves))]
+    # The append methods are bound once as arguments of an enclosing function, so the record function finds them as closure variables
+    source = f"def make_flatten_record({', '.join(appends)}):\n"
+    source += "    def flatten_record(record):\n"
+    source += "".join(line + "\n" for line in lines)
+    source += "".join(f"        {append}({leaf})\n" for append, leaf in zip(appends, leaves))
+    if not lines:
+        source += "        pass\n"
+    source += "    return flatten_record\n"
+    exec(compile(source, "<flatten_record>", "exec"), namespace)
+    return namespace["make_flatten_record"](*(column.append for column in columns))
+
+
+def only_checks_types(schema):
+    """Function that tells whether validating a record against the schema only involves checking the type of its fields,
+    in which case the validation can be done by the flattener generated with check_types.
+    E.g:
+     schema =  {
+                    'type': 'object',
+                    'properties': {
+                        'key_1': {'type': ['null', 'integer']},
+                        'key_2': {'type': ['null', 'string'], 'format': 'date-time'}
+                    }
+                }
+    By calling the function with the schema above as parameter, you will get True,
+    while adding 'required': ['key_1'] or an 'items' keyword to any of the fields gives False.
+    """
+    if _VALIDATION_KEYWORDS.intersection(schema):
+        return False
+    if any(t not in _PYTHON_TYPES for t in _json_types(schema)):
+        return False
+    return all(only_checks_types(v) for v in (schema.get("properties") or {}).values())
+
+
+def flatten_schema_types(dictionary):
+    """Function that maps the fields given by flatten_schema, in the same order, to the pyarrow type of their values,
+    so record batches can be built without inferring the types from the values.
+    Lists, free-form objects and the fields whose type is ambiguous are stored as strings, so every file of a stream
+    has the same types whatever the values of its records.
+    E.g:
+     dictionary =  {
+                        'key_1': {'type': ['null', 'integer']},
+                        'key_2': {
+                            'type': ['null', 'object'],
+                            'properties': {
+                                'key_3': {'anyOf': [{'type': 'null'}, {'type': 'string', 'format': 'date-time'}]},
+                                'key_4': {'type': ['null', 'array']},
+                                'key_5': {'type': ['integer', 'string']}
+                            }
+                        }
+                    }
+    By calling the function with the dictionary above as parameter, you will get the following list:
+        [pa.int64(), pa.string(), pa.string(), pa.string()]
+    """
+    items = []
+    if dictionary:
+        for v in dictionary.values():
+            if _has_properties(v):
+                items.extend(flatten_schema_types(v.get("properties")))
+            else:
+                arrow_type = _arrow_type(v)
+                items.append(pa.string() if arrow_type is None else arrow_type)
+    return items
+
+
+def _has_properties(schema):
+    # Only objects with properties are flattened into a field per property
+    return "object" in schema.get("type", []) and bool(schema.get("properties"))
+
+
+def _arrow_type(schema):
+    types = schema.get("type")
+    if types is None:
+        types = [t for option in schema.get("anyOf", []) for t in _json_types(option)]
+    else:
+        types = _json_types(schema)
+    types = frozenset(types) - {"null"}
+    return _ARROW_TYPES.get(types)
+
+
+def _json_types(schema):
+    types = schema.get("type", [])
+    return [types] if isinstance(types, str) else types
+
+
+_ARROW_TYPES = {
+    frozenset(["integer"]): pa.int64(),
+    frozenset(["number"]): pa.float64(),
+    frozenset(["integer", "number"]): pa.float64(),
+    frozenset(["boolean"]): pa.bool_(),
+    frozenset(["string"]): pa.string(),
+    frozenset(["array"]): pa.string(),
+    frozenset(["object"]): pa.string(),
+}
+
+
+class _Missing:
+    pass
+
+
+_MISSING = _Missing()
+
+_PYTHON_TYPES = {
+    "null": (type(None),),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "string": (str,),
+    "array": (list,),
+    "object": (dict,),
+}
+
+# JSON schema keywords that constrain the values beyond their type
+_VALIDATION_KEYWORDS = frozenset(
+    [
+        "enum",
+        "const",
+        "multipleOf",
+        "maximum",
+        "exclusiveMaximum",
+        "minimum",
+        "exclusiveMinimum",
+        "maxLength",
+        "minLength",
+        "pattern",
+        "items",
+        "additionalItems",
+        "maxItems",
+        "minItems",
+        "uniqueItems",
+        "contains",
+        "maxProperties",
+        "minProperties",
+        "required",
+        "additionalProperties",
+        "patternProperties",
+        "dependencies",
+        "propertyNames",
+        "allOf",
+        "anyOf",
+        "oneOf",
+        "not",
+        "if",
+        "$ref",
+    ]
+)
@@ -1,7 +1,14 @@
 import pytest
 import logging
+import pyarrow as pa
 
-from target_parquet.helpers import flatten, flatten_schema
+from target_parquet.helpers import (
+    compile_flattener,
+    flatten,
+    flatten_schema,
+    flatten_schema_types,
+    only_checks_types,
+)
 
 
 def test_flatten():
@@ -87,3 +94,152 @@ def test_flatten_schema_2(caplog):
 def test_flatten_schema_empty():
     in_dict = dict()
     assert list() == flatten_schema(in_dict)
+
+
+def test_flatten_keeps_order():
+    in_dict = {
+        "key_1": {"key_2": {"key_3": 1}, "key_4": {}},
+        "key_5": None,
+        "key_6": {"key_7": [1]},
+    }
+    expected = ["key_1__key_2__key_3", "key_5", "key_6__key_7"]
+
+    output = flatten(in_dict)
+    assert list(output) == expected
+    assert output["key_6__key_7"] == "[1]"
+
+
+def test_compile_flattener():
+    in_dict = {
+        "key_1": {"type": ["null", "integer"]},
+        "key_2": {
+            "type": ["null", "object"],
+            "properties": {
+                "key_3": {"type": ["null", "string"]},
+                "key_4": {
+                    "type": ["null", "object"],
+                    "properties": {
+                        "key_5": {"type": ["null", "integer"]},
+                        "key_6": {"type": ["null", "array"]},
+                    },
+                },
+            },
+        },
+    }
+    records = [
+        {"key_1": 1, "key_2": {"key_3": 2, "key_4": {"key_5": 3, "key_6": ["10", "11"]}}},
+        {"key_1": 1, "key_2": {"key_4": None}, "key_7": 4},
+        {"key_2": None},
+    ]
+    fields = flatten_schema(in_dict)
+    columns = [[] for _ in fields]
+
+    flatten_record = compile_flattener(in_dict, columns)
+    for record in records:
+        flatten_record(record)
+    assert columns == [
+        [flatten(record).get(f) for record in records] for f in fields
+    ]
+
+
+def test_compile_flattener_free_form_object():
+    in_dict = {
+        "key_1": {"type": ["null", "integer"]},
+        "key_2": {"type": ["null", "object"]},
+        "key_3": {"type": "object", "properties": {}},
+    }
+    columns = [[], [], []]
+
+    flatten_record = compile_flattener(in_dict, columns)
+    flatten_record({"key_1": 1, "key_2": {"key_4": 1}, "key_3": {"key_5": [2]}})
+    flatten_record({"key_2": None})
+
+    assert flatten_schema(in_dict) == ["key_1", "key_2", "key_3"]
+    assert flatten_schema_types(in_dict) == [pa.int64(), pa.string(), pa.string()]
+    assert columns == [[1, None], ["{'key_4': 1}", None], ["{'key_5': [2]}", None]]
+
+
+def test_flatten_schema_types():
+    in_dict = {
+        "id": {"type": "integer"},
+        "amount": {"type": ["null", "number"]},
+        "active": {"type": ["boolean", "null"]},
+        "address": {
+            "type": ["null", "object"],
+            "properties": {
+                "street": {"type": ["null", "string"]},
+                "tags": {"type": ["null", "array"], "items": {"type": "string"}},
+            },
+        },
+        "last_surveyed": {
+            "anyOf": [{"type": "null"}, {"type": "string", "format": "date-time"}]
+        },
+        "mixed": {"type": ["integer", "string"]},
+        "unknown": {},
+    }
+    expected = [
+        pa.int64(),
+        pa.float64(),
+        pa.bool_(),
+        pa.string(),
+        pa.string(),
+        pa.string(),
+        pa.string(),
+        pa.string(),
+    ]
+
+    output = flatten_schema_types(in_dict)
+    assert output == expected
+    assert len(output) == len(flatten_schema(in_dict))
+
+
+def test_compile_flattener_check_types():
+    in_dict = {
+        "key_1": {"type": "integer"},
+        "key_2": {
+            "type": ["null", "object"],
+            "properties": {"key_3": {"type": ["null", "string"]}},
+        },
+    }
+    columns = [[], []]
+
+    flatten_record = compile_flattener(in_dict, columns, check_types=True)
+    flatten_record({"key_1": 1, "key_2": {"key_3": "a"}})
+    flatten_record({"key_2": None})
+    assert columns == [[1, None], ["a", None]]
+
+    with pytest.raises(ValueError, match="data.key_1 must be integer"):
+        flatten_record({"key_1": None})
+    with pytest.raises(ValueError, match="data.key_2.key_3 must be null or string"):
+        flatten_record({"key_2": {"key_3": 1}})
+    assert columns == [[1, None], ["a", None]]
+
+    in_dict = {
+        "key_1": {"type": "object", "properties": {"key_2": {"type": "object"}}},
+        "key_3": {"type": "integer"},
+    }
+    columns = [[], []]
+
+    flatten_record = compile_flattener(in_dict, columns, check_types=True)
+    flatten_record({"key_1": {"key_2": {}}, "key_3": 1})
+    assert columns == [["{}"], [1]]
+
+    with pytest.raises(ValueError, match="data.key_1.key_2 must be object"):
+        flatten_record({"key_1": {"key_2": 1}, "key_3": 1})
+    with pytest.raises(ValueError, match="data.key_1 must be object"):
+        flatten_record({"key_1": None, "key_3": 1})
+
+
+def test_only_checks_types():
+    in_dict = {
+        "type": "object",
+        "properties": {
+            "key_1": {"type": ["null", "integer"]},
+            "key_2": {"type": ["null", "string"], "format": "date-time"},
+        },
+    }
+    assert only_checks_types(in_dict)
+    assert not only_checks_types({**in_dict, "required": ["key_1"]})
+    assert not only_checks_types(
+        {"properties": {"key_1": {"type": "array", "items": {"type": "string"}}}}
+    )
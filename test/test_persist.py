@@ -1,7 +1,6 @@
 import pytest
 import io
 from datetime import datetime
-from decimal import Decimal
 import pyarrow as pa
 from pyarrow.parquet import ParquetFile
 from pandas.testing import assert_frame_equal
@@ -11,7 +10,7 @@ import logging
 # from os import walk
 import glob
 import os
-from target_parquet import persist_messages
+from target_parquet import MESSAGE_BATCH_SIZE, persist_messages, read_lines
 
 #### TEMP DEBUG
 
@@ -22,7 +21,7 @@ def expected_df_1():
         {
             "str": ["value1", "value2", "value3"],
             "int": [1, None, 3],
-            "decimal": [Decimal("0.1"), Decimal("0.2"), Decimal("0.3")],
+            "decimal": [0.1, 0.2, 0.3],
             "date": ["2021-06-11", "2021-06-12", "2021-06-13"],
             "datetime": [
                 "2021-06-11T00:00:00.000000Z",
@@ -92,3 +91,279 @@ def test_persist_messages_invalid_sort(input_messages_1_reorder):
         match="A record for stream test was encountered before a corresponding schema",
     ):
         persist_messages(input_messages, "test_")
+
+
+def test_persist_messages_file_size(input_messages_1):
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    input_messages = io.TextIOWrapper(
+        io.BytesIO(input_messages_1.encode()), encoding="utf-8"
+    )
+
+    persist_messages(input_messages, f"test_{timestamp}", file_size=2)
+
+    filename = sorted(glob.glob(f"test_{timestamp}/*.parquet"))
+
+    num_rows = [ParquetFile(f).metadata.num_rows for f in filename]
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert num_rows == [2, 1]
+
+
+def test_persist_messages_invalid_record():
+    input_messages = io.TextIOWrapper(
+        io.BytesIO(
+            b"""\
+{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"int": {"type": ["null", "integer"]}}}, "key_properties": []}
+{"type": "RECORD", "stream": "test", "record": {"int": "1"}}
+"""
+        ),
+        encoding="utf-8",
+    )
+
+    with pytest.raises(ValueError, match="must be null or integer"):
+        persist_messages(input_messages, "test_", validate_records=True)
+
+
+def test_persist_messages_fractional_integer():
+    input_messages = io.TextIOWrapper(
+        io.BytesIO(
+            b"""\
+{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"int": {"type": ["null", "integer"]}}}, "key_properties": []}
+{"type": "RECORD", "stream": "test", "record": {"int": 1.5}}
+"""
+        ),
+        encoding="utf-8",
+    )
+
+    with pytest.raises(pa.ArrowInvalid, match="truncated"):
+        persist_messages(input_messages, "test_")
+
+
+def test_persist_messages_row_group_size(input_messages_1):
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    input_messages = io.TextIOWrapper(
+        io.BytesIO(input_messages_1.encode()), encoding="utf-8"
+    )
+
+    persist_messages(input_messages, f"test_{timestamp}", row_group_size=2)
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*.parquet")]
+
+    metadata = ParquetFile(filename[0]).metadata
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert [
+        metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)
+    ] == [2, 1]
+    assert metadata.row_group(0).column(0).statistics.has_min_max
+
+
+def test_persist_messages_row_group_size_across_batches():
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    schema = b"""{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"int": {"type": ["null", "integer"]}}}, "key_properties": []}\n"""
+    record = b"""{"type": "RECORD", "stream": "test", "record": {"int": 1}}\n"""
+    input_messages = io.TextIOWrapper(
+        io.BytesIO(schema + record * (5 * MESSAGE_BATCH_SIZE // 2)), encoding="utf-8"
+    )
+
+    persist_messages(input_messages, f"test_{timestamp}", row_group_size=1000)
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*.parquet")]
+
+    metadata = ParquetFile(filename[0]).metadata
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert [
+        metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)
+    ] == [1000, 1000, 560]
+
+
+def test_persist_messages_interleaved_streams():
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    input_messages = io.TextIOWrapper(
+        io.BytesIO(
+            b"""\
+{"type": "SCHEMA","stream": "test_1","schema": {"type": "object","properties": {"int": {"type": ["null", "integer"]}}}, "key_properties": []}
+{"type": "SCHEMA","stream": "test_2","schema": {"type": "object","properties": {"str": {"type": ["null", "string"]}}}, "key_properties": []}
+{"type": "RECORD", "stream": "test_1", "record": {"int": 1}}
+{"type": "RECORD", "stream": "test_2", "record": {"str": "value1"}}
+{"type": "RECORD", "stream": "test_1", "record": {"int": 2}}
+{"type": "RECORD", "stream": "test_2", "record": {"str": "value2"}}
+"""
+        ),
+        encoding="utf-8",
+    )
+
+    persist_messages(input_messages, f"test_{timestamp}")
+
+    filename = sorted(glob.glob(f"test_{timestamp}/*.parquet"))
+
+    tables = [ParquetFile(f).read().to_pydict() for f in filename]
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert tables == [{"int": [1, 2]}, {"str": ["value1", "value2"]}]
+
+
+def test_persist_messages_repeated_schema():
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    input_messages = io.TextIOWrapper(
+        io.BytesIO(
+            b"""\
+{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"int": {"type": ["null", "integer"]}}}, "key_properties": []}
+{"type": "RECORD", "stream": "test", "record": {"int": 1}}
+{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"int": {"type": ["null", "integer"]}}}, "key_properties": []}
+{"type": "RECORD", "stream": "test", "record": {"int": 2}}
+"""
+        ),
+        encoding="utf-8",
+    )
+
+    persist_messages(input_messages, f"test_{timestamp}")
+
+    filename = sorted(glob.glob(f"test_{timestamp}/*.parquet"))
+
+    tables = [ParquetFile(f).read().to_pydict() for f in filename]
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert tables == [{"int": [1, 2]}]
+
+
+def test_persist_messages_schema_type_change():
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    input_messages = io.TextIOWrapper(
+        io.BytesIO(
+            b"""\
+{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"a": {"type": ["null", "string"]}}}, "key_properties": []}
+{"type": "RECORD", "stream": "test", "record": {"a": "x"}}
+{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"a": {"type": ["null", "integer"]}}}, "key_properties": []}
+{"type": "RECORD", "stream": "test", "record": {"a": 5}}
+"""
+        ),
+        encoding="utf-8",
+    )
+
+    persist_messages(input_messages, f"test_{timestamp}")
+
+    filename = sorted(glob.glob(f"test_{timestamp}/*.parquet"))
+
+    tables = [ParquetFile(f).read().to_pydict() for f in filename]
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert tables == [{"a": ["x"]}, {"a": [5]}]
+
+
+def test_persist_messages_free_form_object():
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    input_messages = io.TextIOWrapper(
+        io.BytesIO(
+            b"""\
+{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"a": {"type": ["null", "integer"]},"meta": {"type": ["null", "object"]}}}, "key_properties": []}
+{"type": "RECORD", "stream": "test", "record": {"a": 1, "meta": {"x": 1}}}
+"""
+        ),
+        encoding="utf-8",
+    )
+
+    persist_messages(input_messages, f"test_{timestamp}")
+
+    filename = sorted(glob.glob(f"test_{timestamp}/*.parquet"))
+
+    tables = [ParquetFile(f).read().to_pydict() for f in filename]
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert tables == [{"a": [1], "meta": ["{'x': 1}"]}]
+
+
+def test_persist_messages_ambiguous_type():
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    schema = b"""{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"a": {"type": ["null", "integer", "string"]}}}, "key_properties": []}\n"""
+    null_record = b"""{"type": "RECORD", "stream": "test", "record": {"a": null}}\n"""
+    records = b"""\
+{"type": "RECORD", "stream": "test", "record": {"a": "x"}}
+{"type": "RECORD", "stream": "test", "record": {"a": 5}}
+"""
+    input_messages = io.TextIOWrapper(
+        io.BytesIO(schema + null_record * MESSAGE_BATCH_SIZE + records),
+        encoding="utf-8",
+    )
+
+    persist_messages(input_messages, f"test_{timestamp}")
+
+    filename = sorted(glob.glob(f"test_{timestamp}/*.parquet"))
+
+    tables = [ParquetFile(f).read() for f in filename]
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert len(tables) == 1
+    assert tables[0].schema.field("a").type == pa.string()
+    assert tables[0].column("a").to_pylist()[-2:] == ["x", "5"]
+
+
+def test_read_lines():
+    input_messages = b'{"a": 1}\n{"b": "long line"}\n\n{"c": 3}'
+
+    lines = list(read_lines(io.BytesIO(input_messages), buffer_size=4))
+
+    assert lines == [b'{"a": 1}', b'{"b": "long line"}', b"", b'{"c": 3}']
+
+
+def test_persist_messages_list_of_lines(input_messages_1, expected_df_1):
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    persist_messages(input_messages_1.splitlines(), f"test_{timestamp}")
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*.parquet")]
+
+    df = ParquetFile(filename[0]).read().to_pandas()
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert_frame_equal(df, expected_df_1)
+
+
+def test_persist_messages_missing_key():
+    input_messages = io.TextIOWrapper(
+        io.BytesIO(
+            b"""\
+{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"int": {"type": ["null", "integer"]}}}}
+"""
+        ),
+        encoding="utf-8",
+    )
+
+    with pytest.raises(Exception, match="Message is missing required key 'key_properties'"):
+        persist_messages(input_messages, "test_")